@@ -0,0 +1,134 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+from mediatools import Preset
+
+log = logging.getLogger(__name__)
+
+
+class BatchException(Exception):
+    pass
+
+
+class BatchJob:
+    def __init__(self, name, file_list, out_path, preset_name, preset: Preset, logfile, tuning=None):
+        self.name = name
+        self.file_list = file_list
+        self.out_path = out_path
+        self.preset_name = preset_name
+        self.preset = preset
+        self.logfile = logfile
+        self.tuning = tuning
+
+        self.thread = None
+        self.success = None
+        self.started = None
+        self.finished = None
+
+    def get_cpu_cost(self, cpu_budget):
+        """Stream copy jobs are I/O bound and only count against the disk budget."""
+        if self.preset.stream_copy:
+            return 0
+        if self.tuning:
+            return min(self.tuning.threads, cpu_budget)
+        return cpu_budget
+
+    def get_io_cost(self):
+        return 1 if self.preset.stream_copy else 0
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+
+class BatchScheduler:
+    """
+    Runs the concatenation of several jobs at once, as long as the sum of their CPU and disk costs fits in the
+    budget. Jobs are started in order, but a job that fits may overtake one that has to wait for resources, so
+    e.g. stream copy jobs can run alongside a transcode.
+    """
+    def __init__(self, mediatools, cpu_budget, io_budget):
+        if cpu_budget < 1 or io_budget < 1:
+            raise BatchException("CPU and disk budgets must be at least 1")
+        self._mediatools = mediatools
+        self.cpu_budget = cpu_budget
+        self.io_budget = io_budget
+        self._cancel = threading.Event()
+
+    def _fits(self, job, running):
+        cpu_used = sum(j.get_cpu_cost(self.cpu_budget) for j in running)
+        io_used = sum(j.get_io_cost() for j in running)
+        cpu_fits = not job.get_cpu_cost(self.cpu_budget) or cpu_used + job.get_cpu_cost(self.cpu_budget) <= self.cpu_budget
+        io_fits = not job.get_io_cost() or io_used + job.get_io_cost() <= self.io_budget
+        return cpu_fits and io_fits
+
+    def _run_job(self, job):
+        job.started = time.monotonic()
+        try:
+            job.success = self._mediatools.do_concatenation(
+                job.file_list, job.out_path, job.preset, job.logfile, job.tuning, cancel=self._cancel,
+                name=job.name
+            )
+        except Exception as e:
+            log.error("[%s] %s", job.name, str(e))
+            job.success = False
+        finally:
+            job.finished = time.monotonic()
+
+    def run(self, jobs):
+        pending = list(jobs)
+        running = []
+
+        try:
+            while pending or running:
+                for job in list(running):
+                    if not job.thread.is_alive():
+                        running.remove(job)
+                        log.info("[%s] %s after %s", job.name, "Finished" if job.success else "FAILED",
+                                 datetime.timedelta(seconds=round(job.elapsed)))
+
+                for job in list(pending):
+                    if self._fits(job, running):
+                        pending.remove(job)
+                        log.info("[%s] Starting with preset '%s'%s", job.name, job.preset_name,
+                                 f" ({job.tuning})" if job.tuning else "")
+                        job.thread = threading.Thread(target=self._run_job, args=(job,), name=job.name)
+                        job.thread.start()
+                        running.append(job)
+
+                if pending and not running:
+                    raise BatchException("Job {} does not fit in the CPU/disk budget".format(pending[0].name))
+
+                time.sleep(.5)
+        except KeyboardInterrupt as e:
+            self._cancel.set()
+            for job in running:
+                job.thread.join()
+            raise e
+
+
+def log_summary(jobs):
+    log.info("Batch summary:")
+    for job in jobs:
+        runtime = job.file_list.get_total_duration_ms()
+        if job.success is None:
+            status = "NOT RUN"
+        else:
+            status = "OK" if job.success else "FAILED"
+        speed = ""
+        if runtime and job.elapsed:
+            speed = "{:.2f}x realtime".format(runtime / 1000 / job.elapsed)
+        log.info(
+            " - %-7s %s: %d files, %s of video in %s %s",
+            status, job.name, len(job.file_list.paths),
+            str(datetime.timedelta(milliseconds=runtime)) if runtime else "unknown",
+            datetime.timedelta(seconds=round(job.elapsed)) if job.elapsed is not None else "-",
+            speed
+        )
+        if not job.success and job.logfile:
+            log.info("   log: %s", os.path.abspath(job.logfile))
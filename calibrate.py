@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from appdirs import user_config_dir
+
+log = logging.getLogger(__name__)
+
+# x264/x265 speed presets, fastest first
+SPEED_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+DEFAULT_SPEED_PRESETS = ["veryfast", "faster", "fast", "medium", "slow"]
+
+
+def default_thread_counts():
+    cpus = os.cpu_count() or 1
+    return sorted({max(1, cpus // 4), max(1, cpus // 2), cpus})
+
+
+class CalibrationException(Exception):
+    pass
+
+
+class EncoderTuning:
+    def __init__(self, speed_preset, threads):
+        self.speed_preset = speed_preset
+        self.threads = threads
+
+    def __str__(self):
+        return f"-preset {self.speed_preset} with {self.threads} threads"
+
+
+class Measurement:
+    def __init__(self, data=None):
+        self.speed_preset = None
+        self.threads = None
+        self.realtime_factor = None
+        self.bitrate_kbps = None
+
+        if data is not None:
+            self.__dict__.update(data)
+
+    def to_dict(self):
+        return self.__dict__
+
+    def to_tuning(self):
+        return EncoderTuning(self.speed_preset, self.threads)
+
+
+def select_tuning(measurements, required_realtime_factor):
+    """
+    Pick the slowest (best compressing) speed preset that still meets the required realtime factor, using the fewest
+    threads that do so. Falls back to the fastest measurement if nothing meets the target.
+    """
+    if not measurements:
+        return None
+
+    meeting = [m for m in measurements if m.realtime_factor >= required_realtime_factor]
+    if not meeting:
+        fastest = max(measurements, key=lambda m: m.realtime_factor)
+        log.warning(
+            "No calibrated setting reaches %.2fx realtime; using the fastest one (%.2fx)",
+            required_realtime_factor, fastest.realtime_factor
+        )
+        return fastest.to_tuning()
+
+    best = max(meeting, key=lambda m: (SPEED_PRESETS.index(m.speed_preset), -m.threads))
+    return best.to_tuning()
+
+
+class HostProfile:
+    """
+    Encoder calibration results for this host, keyed by preset name. The profile file can hold entries for several
+    hosts, so a shared home directory doesn't mix up a laptop and an encode server.
+    """
+    def __init__(self, host=None):
+        self.host = host or platform.node()
+        self.presets = {}
+
+    def _get_path(self, ensure_path_exists):
+        config_dir = user_config_dir('catvid', 'bad-bit')
+        config_file = os.path.join(config_dir, 'calibration.json')
+        if ensure_path_exists:
+            os.makedirs(config_dir, exist_ok=True)
+        return config_file
+
+    def _load_all(self):
+        try:
+            with open(self._get_path(ensure_path_exists=False), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"hosts": {}}
+
+    def load(self):
+        self.presets = self._load_all()["hosts"].get(self.host, {})
+        if self.presets:
+            log.debug("Loaded calibration profile for host %s", self.host)
+
+    def save(self):
+        data = self._load_all()
+        data["hosts"][self.host] = self.presets
+        with open(self._get_path(ensure_path_exists=True), 'w') as f:
+            json.dump(data, f, indent=2)
+        log.info("Saved calibration profile for host %s", self.host)
+
+    def set_calibration(self, preset_name, measurements, target_realtime=None, target_hours=None):
+        self.presets[preset_name] = {
+            "target_realtime": target_realtime,
+            "target_hours": target_hours,
+            "measurements": [m.to_dict() for m in measurements],
+        }
+
+    def get_required_realtime_factor(self, preset_name, duration_ms):
+        entry = self.presets[preset_name]
+        required = entry["target_realtime"] or 0
+        if entry["target_hours"]:
+            if duration_ms:
+                required = max(required, duration_ms / 3600_000 / entry["target_hours"])
+            elif not required:
+                log.warning("Total duration of the input is unknown, so the target of finishing within %s hours can't "
+                            "be applied; aiming for 1.0x realtime instead", entry["target_hours"])
+                required = 1.0
+        return required
+
+    def get_tuning(self, preset_name, duration_ms):
+        if preset_name not in self.presets:
+            return None
+        measurements = [Measurement(m) for m in self.presets[preset_name]["measurements"]]
+        return select_tuning(measurements, self.get_required_realtime_factor(preset_name, duration_ms))
+
+
+def pick_sample(file_list, sample_seconds):
+    """
+    Returns (path, start offset, length) in seconds of a sample from the middle of the longest file in the list.
+    Only files with a known duration are considered, as otherwise the encoded length of the sample is unknown too,
+    and the measured speed would be off.
+    """
+    known = [p for p in file_list.paths if file_list.meta[p].milliseconds]
+    if not known:
+        raise CalibrationException("Duration of the input files is unknown; can't take a calibration sample")
+    if len(known) < len(file_list.paths):
+        log.warning("Skipping %d files with unknown duration for calibration", len(file_list.paths) - len(known))
+
+    path = max(known, key=lambda p: file_list.meta[p].milliseconds)
+    duration_s = file_list.meta[path].milliseconds / 1000
+    if duration_s < sample_seconds:
+        return path, 0.0, duration_s
+    return path, (duration_s - sample_seconds) / 2, sample_seconds
+
+
+def run_calibration(mediatools, file_list, preset, speed_presets, thread_counts, sample_seconds):
+    path, start_s, length_s = pick_sample(file_list, sample_seconds)
+    log.info("Calibrating on %.1fs of %s starting at %.1fs", length_s, path, start_s)
+
+    measurements = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        out_file = os.path.join(tempdir, "sample.mkv")
+        for speed_preset in speed_presets:
+            for threads in thread_counts:
+                tuning = EncoderTuning(speed_preset, threads)
+                args = preset.get_sample_commandline(mediatools.ffmpeg_exe, path, start_s, length_s, out_file, tuning)
+                log.debug("Executing: %s", " ".join("'" + a + "'" for a in args))
+                start = time.monotonic()
+                result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                        stdin=subprocess.DEVNULL)
+                elapsed = time.monotonic() - start
+                if result.returncode != 0:
+                    log.warning("Encoding sample with %s failed; skipping", tuning)
+                    continue
+
+                measurement = Measurement({
+                    "speed_preset": speed_preset,
+                    "threads": threads,
+                    "realtime_factor": length_s / elapsed,
+                    "bitrate_kbps": os.path.getsize(out_file) * 8 / length_s / 1000,
+                })
+                log.info(" - %-9s %3d threads: %6.2fx realtime, %8.0f kbps",
+                         speed_preset, threads, measurement.realtime_factor, measurement.bitrate_kbps)
+                measurements.append(measurement)
+
+    if not measurements:
+        raise CalibrationException("All calibration encodes failed. Re-run with --verbose to see the commands used.")
+    return measurements
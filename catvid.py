@@ -4,12 +4,17 @@ import json
 import logging
 import platform
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from appdirs import *
 
+from batch import BatchJob, BatchScheduler, BatchException, log_summary
+from calibrate import HostProfile, SPEED_PRESETS, DEFAULT_SPEED_PRESETS, CalibrationException, \
+    default_thread_counts, run_calibration
 from metacache import MetaCache
 from mediatools import encode_presets, MediaTools, MediaToolsNotInstalledException, FileList
 from report import write_txt_report, write_xlsx_report, write_srt
+from thumbnails import generate_thumbnails, write_contact_sheet
 from util import confirm_overwrite
 
 log = logging.getLogger(__name__)
@@ -37,7 +42,214 @@ def relative_to_or_absolute(path, relative_to_file):
         return os.path.abspath(path)
 
 
+def positive_int(value):
+    result = int(value)
+    if result < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return result
+
+
+def positive_float(value):
+    result = float(value)
+    if result <= 0:
+        raise argparse.ArgumentTypeError("must be greater than 0")
+    return result
+
+
+def get_input_files(file_args, in_collection):
+    if file_args and in_collection:
+        raise UserInputException("Specifying both input collection file and separate input video files is not supported")
+    elif file_args:
+        files = file_args
+        if platform.system() == "Windows":
+            files = [f for p in file_args for f in glob.glob(p)]
+    elif in_collection:
+        with open(in_collection, 'r') as f:
+            files = [absolute_from_maybe_relative(p, in_collection) for p in json.load(f)["files"]]
+    else:
+        raise UserInputException("Must specify either input collection file, or separate video files")
+
+    return [str(Path(f).resolve()) for f in files]
+
+
+def calibrate_main(argv):
+    tools = MediaTools()
+    cache = MetaCache()
+
+    tunable_presets = [name for name, preset in encode_presets.items() if preset.tunable]
+
+    parser = argparse.ArgumentParser(
+        prog="catvid calibrate",
+        description="Measure encoding speed and bitrate of a preset on this host, using a sample from the given "
+                    "videos, and store the speed preset/thread count that meets the target in a per-host profile. "
+                    "Later runs with that preset use the stored settings automatically.")
+
+    parser.add_argument("--verbose", "-v", action="store_true", help="Activate verbose mode (debug logging)")
+    parser.add_argument("--preset", "-p", type=str, required=True, choices=tunable_presets,
+                        help="Ffmpeg preset to calibrate")
+    parser.add_argument("--in-collection", "-i", type=str, metavar="CVC",
+                        help="Collection file to take the sample from. "
+                             "Cannot be combined with command-line specified input files.")
+    parser.add_argument("--sample-seconds", type=positive_float, default=20,
+                        help="Length of the sample to encode for every setting. Default: 20")
+    parser.add_argument("--speeds", type=str, nargs="+", choices=SPEED_PRESETS, default=DEFAULT_SPEED_PRESETS,
+                        help="Encoder speed presets to try. Default: " + " ".join(DEFAULT_SPEED_PRESETS))
+    parser.add_argument("--threads", type=positive_int, nargs="+", default=default_thread_counts(),
+                        help="Thread counts to try. Default: a quarter, half and all of this host's cores")
+    parser.add_argument("--target-realtime", type=float, metavar="FACTOR",
+                        help="Encode at least FACTOR times faster than realtime. "
+                             "Default: 1.0 if --target-hours is not given either")
+    parser.add_argument("--target-hours", type=float, metavar="HOURS",
+                        help="Finish encoding a collection within HOURS hours")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the metadata cache")
+
+    parser.add_argument("file", nargs="*", type=str, help="Input video files")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stdout)
+
+    target_realtime = args.target_realtime
+    if target_realtime is None and args.target_hours is None:
+        target_realtime = 1.0
+
+    if not args.no_cache:
+        cache.load()
+
+    file_list = FileList(mediatools=tools, metacache=cache)
+    for file in get_input_files(args.file, args.in_collection):
+        file_list.add_file(file)
+
+    if not args.no_cache:
+        cache.save()
+
+    measurements = run_calibration(tools, file_list, encode_presets[args.preset], args.speeds, args.threads,
+                                   args.sample_seconds)
+
+    profile = HostProfile()
+    profile.load()
+    profile.set_calibration(args.preset, measurements, target_realtime, args.target_hours)
+    profile.save()
+
+    log.info("For this collection, preset '%s' will use %s",
+             args.preset, profile.get_tuning(args.preset, file_list.get_total_duration_ms()))
+
+
+def batch_main(argv):
+    tools = MediaTools()
+    cache = MetaCache()
+
+    parser = argparse.ArgumentParser(
+        prog="catvid batch",
+        description="Run many concatenation jobs in one go, sharing the metadata cache and probing files in parallel. "
+                    "Jobs run concurrently within a CPU and disk budget, so stream copy jobs can overlap transcodes.")
+
+    parser.add_argument("--verbose", "-v", action="store_true", help="Activate verbose mode (debug logging)")
+    parser.add_argument("--cpus", type=positive_int, default=os.cpu_count() or 1,
+                        help="CPU threads transcoding jobs may use in total. A job uses its calibrated thread count, "
+                             "or the whole budget if the host isn't calibrated for its preset. "
+                             "Default: number of cores")
+    parser.add_argument("--io-jobs", type=positive_int, default=1,
+                        help="Number of disk bound stream copy jobs to run at the same time. Default: 1")
+    parser.add_argument("--probe-jobs", type=positive_int, default=os.cpu_count() or 1,
+                        help="Number of input files to analyze in parallel. Default: number of cores")
+    parser.add_argument("--no-reports", action="store_true",
+                        help="Don't write XLSX/TXT/SRT files next to the job outputs.")
+    parser.add_argument("--no-thumbnails", action="store_true",
+                        help="Don't add a thumbnail of every input file to the XLSX reports.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the metadata cache")
+    parser.add_argument("--no-calibration", action="store_true",
+                        help="Ignore this host's encoder calibration profile (see 'catvid calibrate --help')")
+    parser.add_argument("--overwrite", "-y", action="store_true", help="Don't ask before overwriting existing files.")
+
+    parser.add_argument("jobs", type=str, metavar="JOBS",
+                        help="JSON file with a list of jobs: "
+                             '{"jobs": [{"collection": "a.cvc", "out": "a.mkv", "preset": "copy", "sort": "time"}]}. '
+                             'Use "files": [...] instead of "collection" to list input files directly. '
+                             "preset and sort are optional (default: copy, time). "
+                             "Relative paths are relative to the jobs file.")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stdout)
+
+    with open(args.jobs, 'r') as f:
+        job_specs = json.load(f)["jobs"]
+
+    for spec in job_specs:
+        if "out" not in spec:
+            raise UserInputException("Every job needs an 'out' file")
+        if spec.get("preset", "copy") not in encode_presets:
+            raise UserInputException("Unknown preset '{}'".format(spec["preset"]))
+        spec["out"] = os.path.abspath(absolute_from_maybe_relative(spec["out"], args.jobs))
+        if "collection" in spec:
+            spec["collection"] = absolute_from_maybe_relative(spec["collection"], args.jobs)
+        if "files" in spec:
+            spec["files"] = [absolute_from_maybe_relative(p, args.jobs) for p in spec["files"]]
+
+    outs = [os.path.normcase(spec["out"]) for spec in job_specs]
+    duplicates = sorted({spec["out"] for spec, out in zip(job_specs, outs) if outs.count(out) > 1})
+    if duplicates:
+        raise UserInputException("Several jobs write to the same output file: {}".format(", ".join(duplicates)))
+
+    report_exts = [] if args.no_reports else ["xlsx", "txt", "srt"]
+    if not args.overwrite:
+        for spec in job_specs:
+            for path in [spec["out"]] + [replace_extension(spec["out"], ext) for ext in report_exts + ["log"]]:
+                confirm_overwrite(path)
+
+    if not args.no_cache:
+        cache.load()
+
+    profile = HostProfile()
+    if not args.no_calibration:
+        profile.load()
+
+    scheduler = BatchScheduler(tools, cpu_budget=args.cpus, io_budget=args.io_jobs)
+    jobs = []
+    with ThreadPoolExecutor(max_workers=args.probe_jobs) as probe_pool:
+        for spec in job_specs:
+            # Output paths are unique, basenames need not be
+            name = relative_to_or_absolute(spec["out"], os.path.abspath(args.jobs))
+            files = get_input_files(spec.get("files"), spec.get("collection"))
+            log.info("[%s] Analyzing %s files", name, len(files))
+
+            file_list = FileList(mediatools=tools, metacache=cache)
+            file_list.add_files(files, probe_pool)
+            sort_file_list(file_list, spec.get("sort", "time"))
+
+            if report_exts:
+                thumbnails = None
+                if not args.no_thumbnails:
+                    log.info("[%s] Extracting thumbnails", name)
+                    thumbnails = generate_thumbnails(tools, file_list, probe_pool)
+                write_reports(file_list, *(replace_extension(spec["out"], ext) for ext in report_exts), thumbnails)
+
+            preset_name = spec.get("preset", "copy")
+            tuning = None if args.no_calibration else get_calibrated_tuning(preset_name, file_list, profile)
+            jobs.append(BatchJob(name, file_list, spec["out"], preset_name, encode_presets[preset_name],
+                                 replace_extension(spec["out"], "log"), tuning))
+
+    if not args.no_cache:
+        cache.save()
+
+    try:
+        scheduler.run(jobs)
+    finally:
+        log_summary(jobs)
+
+    if not all(job.success for job in jobs):
+        sys.exit(1)
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "calibrate":
+        calibrate_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch_main(sys.argv[2:])
+        return
+
     tools = MediaTools()
     cache = MetaCache()
 
@@ -78,6 +290,14 @@ def main():
                              "start of each new video file. Default is next to --out.")
     parser.add_argument("--no-srt", "-S", action="store_true", help="Disable writing of SRT subtitles files.")
 
+    parser.add_argument("--no-thumbnails", action="store_true",
+                        help="Don't add a thumbnail of every input file to the XLSX report.")
+    parser.add_argument("--thumbnail-jobs", type=positive_int, default=os.cpu_count() or 1,
+                        help="Number of thumbnails to extract in parallel. Default: number of cores")
+    parser.add_argument("--contact-sheet", metavar="IMAGE", type=str,
+                        help="Image file (e.g. .jpg or .png) to write all thumbnails to, tiled in file order. "
+                             "Thumbnails are still extracted for this with --no-thumbnails.")
+
     parser.add_argument("--out", "-o", metavar="FILE", type=str, help="Output video filename to write to")
 
     parser.add_argument("--no-cache", action="store_true", help="Don't use the metadata cache")
@@ -90,6 +310,10 @@ def main():
     parser.add_argument("--list-presets", "-P", action="store_true",
                         help="List the ffmpeg presets available for encoding")
 
+    parser.add_argument("--no-calibration", action="store_true",
+                        help="Ignore this host's encoder calibration profile (see 'catvid calibrate --help') "
+                             "and use the preset's default speed settings")
+
     parser.add_argument("--overwrite", "-y", action="store_true", help="Don't ask before overwriting existing files.")
 
     parser.add_argument("file", nargs="*", type=str, help="Input video files")
@@ -118,6 +342,8 @@ def main():
     txt = get_meta_out_file(args.txt, args.no_txt, args.overwrite, args.out, "txt")
     cvc = get_meta_out_file(args.collection, args.no_collection, args.overwrite, args.out, "cvc")
     srt = get_meta_out_file(args.srt, args.no_srt, args.overwrite, args.out, "srt")
+    if args.contact_sheet and not args.overwrite:
+        confirm_overwrite(args.contact_sheet)
 
     out_path = None
     logfile = None
@@ -128,19 +354,7 @@ def main():
 
         logfile = get_meta_out_file(args.log, args.no_log, args.overwrite, args.out, "log")
 
-    if args.file and args.in_collection:
-        raise UserInputException("Specifying both input collection file and separate input video files is not supported")
-    elif args.file:
-        files = args.file
-        if platform.system() == "Windows":
-            files = [f for p in args.file for f in glob.glob(p)]
-    elif args.in_collection:
-        with open(args.in_collection, 'r') as f:
-            files = [absolute_from_maybe_relative(p, args.in_collection) for p in json.load(f)["files"]]
-    else:
-        raise UserInputException("Must specify either input collection file, or separate video files")
-
-    files = [str(Path(f).resolve()) for f in files]
+    files = get_input_files(args.file, args.in_collection)
 
     meta_description = " and ".join(t for t in ['xlsx', 'txt'] if args.__dict__[t])
 
@@ -164,21 +378,51 @@ def main():
     if not args.no_cache:
         cache.save()
 
-    if args.sort == "name":
-        file_list.sort_by_filename()
-    elif args.sort == "path":
-        file_list.sort_by_path()
-    elif args.sort == "time":
-        file_list.sort_by_datetime()
+    sort_file_list(file_list, args.sort)
 
     if cvc:
         log.info("Writing catvid collection %s", cvc)
         with open(cvc, 'w') as f:
             json.dump({"files": [relative_to_or_absolute(p, cvc) for p in files]}, f)
 
+    thumbnails = None
+    if (xlsx and not args.no_thumbnails) or args.contact_sheet:
+        log.info("Extracting thumbnails")
+        with ThreadPoolExecutor(max_workers=args.thumbnail_jobs) as thumbnail_pool:
+            thumbnails = generate_thumbnails(tools, file_list, thumbnail_pool)
+
+    write_reports(file_list, xlsx, txt, srt, None if args.no_thumbnails else thumbnails)
+
+    if args.contact_sheet:
+        log.info("Writing contact sheet %s", args.contact_sheet)
+        write_contact_sheet(tools, file_list, thumbnails, args.contact_sheet)
+
+    if out_path:
+        tuning = None
+        if not args.no_calibration:
+            tuning = get_calibrated_tuning(args.preset, file_list)
+            if tuning:
+                log.info("Using calibrated encoder settings for this host: %s", tuning)
+
+        log.info("Starting concatenation")
+        tools.do_concatenation(file_list, out_path, encode_presets[args.preset], logfile, tuning)
+
+    log.info("Done.")
+
+
+def sort_file_list(file_list, sort):
+    if sort == "name":
+        file_list.sort_by_filename()
+    elif sort == "path":
+        file_list.sort_by_path()
+    elif sort == "time":
+        file_list.sort_by_datetime()
+
+
+def write_reports(file_list, xlsx, txt, srt, thumbnails=None):
     if xlsx:
         log.info("Writing XLSX report %s", xlsx)
-        write_xlsx_report(xlsx, file_list)
+        write_xlsx_report(xlsx, file_list, thumbnails)
 
     if txt:
         log.info("Writing TXT report %s", txt)
@@ -188,11 +432,14 @@ def main():
         log.info("Writing SRT subtitles %s", srt)
         write_srt(srt, file_list)
 
-    if out_path:
-        log.info("Starting concatenation")
-        tools.do_concatenation(file_list, out_path, encode_presets[args.preset], logfile)
 
-    log.info("Done.")
+def get_calibrated_tuning(preset_name, file_list, profile=None):
+    if not encode_presets[preset_name].tunable:
+        return None
+    if profile is None:
+        profile = HostProfile()
+        profile.load()
+    return profile.get_tuning(preset_name, file_list.get_total_duration_ms())
 
 
 def get_meta_out_file(arg, disable_arg, overwrite_arg, out_path, ext):
@@ -207,7 +454,8 @@ def get_meta_out_file(arg, disable_arg, overwrite_arg, out_path, ext):
 if __name__ == '__main__':
     try:
         main()
-    except (MediaToolsNotInstalledException, UserInputException, FileExistsError, OSError) as e:
+    except (MediaToolsNotInstalledException, UserInputException, CalibrationException, BatchException,
+            FileExistsError, OSError) as e:
         log.error("%s", str(e))
         sys.exit(-1)
     except KeyboardInterrupt:
@@ -4,12 +4,16 @@ import logging
 import os
 import subprocess
 import tempfile
+import threading
 import time
+from concurrent.futures import Executor
 from enum import Enum
 from shutil import which, rmtree
 
+from calibrate import EncoderTuning
 from meta import FileMeta
 from metacache import MetaCache
+from mp4concat import concatenate_mp4, Mp4ConcatUnsupported
 from util import open_if_exists, ms_to_mm_ss_ms
 
 log = logging.getLogger(__name__)
@@ -20,6 +24,8 @@ class ConcatStrategy(Enum):
     CONCAT_FILTER = 1
     CONCAT_DEMUX = 2
     CONCAT_PROTOCOL_VIA_REMUX = 3
+    # Joins MP4/MOV files without ffmpeg if possible, otherwise the same as CONCAT_DEMUX
+    CONCAT_NATIVE_MP4 = 4
 
 
 
@@ -32,12 +38,43 @@ class Preset:
         self.concat_strategy = concat_strategy
         self.complex_filters = complex_filters
 
-    def get_commandlines(self, ffmpeg_exe: str, file_list: 'FileList', out_file: str):
+    @property
+    def stream_copy(self):
+        return self.video_params == ["-c", "copy"]
+
+    @property
+    def tunable(self):
+        """Whether the encoder speed preset and thread count can be set from a host calibration profile."""
+        return "-preset" in self.video_params
+
+    def get_video_params(self, tuning: EncoderTuning = None):
+        if tuning is None or not self.tunable:
+            return self.video_params
+        params = list(self.video_params)
+        params[params.index("-preset") + 1] = tuning.speed_preset
+        if "libx265" in params:
+            params += ["-x265-params", f"pools={tuning.threads}"]
+        else:
+            params += ["-threads", str(tuning.threads)]
+        return params
+
+    def get_sample_commandline(self, ffmpeg_exe: str, in_file: str, start_s: float, length_s: float, out_file: str,
+                               tuning: EncoderTuning = None):
+        args = [ffmpeg_exe, "-y"]
+        args += self.decode_params + ["-ss", str(start_s), "-t", str(length_s), "-i", in_file]
+        if self.complex_filters:
+            args += ["-vf", ",".join(self.complex_filters)]
+        args += self.get_video_params(tuning)
+        args += ["-an", out_file]
+        return args
+
+    def get_commandlines(self, ffmpeg_exe: str, file_list: 'FileList', out_file: str, tuning: EncoderTuning = None):
         paths = file_list.paths
+        video_params = self.get_video_params(tuning)
         if self.concat_strategy == ConcatStrategy.CONCAT_PROTOCOL:
             args = [ffmpeg_exe]
             args += self.decode_params + ["-i", "concat:{}".format('|'.join(paths))]
-            args += self.video_params
+            args += video_params
             args += self.audio_params
             return None, [args]
         elif self.concat_strategy == ConcatStrategy.CONCAT_FILTER:
@@ -48,11 +85,11 @@ class Preset:
                 f"concat=n={len(paths)}:v=1:a=1[catv][outa];[catv]" + ",".join(self.complex_filters) + "[outv]",
             ]
             args += ["-map", "[outv]", "-map", "[outa]"]
-            args += self.video_params
+            args += video_params
             args += self.audio_params
             args += [out_file]
             return None, [args]
-        elif self.concat_strategy == ConcatStrategy.CONCAT_DEMUX:
+        elif self.concat_strategy in (ConcatStrategy.CONCAT_DEMUX, ConcatStrategy.CONCAT_NATIVE_MP4):
             args = [ffmpeg_exe]
             tfh, tempfile_path = tempfile.mkstemp(text=True)
             atexit.register(lambda: os.unlink(tempfile_path))
@@ -62,7 +99,7 @@ class Preset:
                     print(f"file 'file:{path}'", file=tf)
 
             args += self.decode_params + ['-f', 'concat', '-safe', '0', '-i', tempfile_path]
-            args += self.video_params
+            args += video_params
             args += self.audio_params
             args += [out_file]
             return None, [args]
@@ -80,7 +117,7 @@ class Preset:
             ]
             
 
-            args = [ffmpeg_exe, "-y", "-f", "mpegts"] + self.decode_params + ["-i", "concat:{}".format('|'.join(ts_paths)), "-bsf:a", "aac_adtstoasc", *self.video_params, "-c:a", "copy", out_file]
+            args = [ffmpeg_exe, "-y", "-f", "mpegts"] + self.decode_params + ["-i", "concat:{}".format('|'.join(ts_paths)), "-bsf:a", "aac_adtstoasc", *video_params, "-c:a", "copy", out_file]
             return None, remux_args + [args]
 
 
@@ -91,9 +128,10 @@ encode_presets = {
         ["-c", "copy"],
         [],
         [],
-        "Directly copy input to output. Uses the FFMPEG concat demuxer to concatenate without re-encoding. "
+        "Directly copy input to output. MP4/MOV files with identical codec parameters are joined directly at close "
+        "to disk speed; anything else uses the FFMPEG concat demuxer to concatenate without re-encoding. "
         "Only suited for concatenating files with the exact same codecs and parameters (e.g. scenes from a camera).",
-        ConcatStrategy.CONCAT_DEMUX
+        ConcatStrategy.CONCAT_NATIVE_MP4
     ),
 
     "copydv": Preset(
@@ -158,7 +196,7 @@ encode_presets = {
         [],
         [
             "-c:v", "libx265", "-crf", "28", "-preset", "medium",
-                "-b:v", "22500k", "-maxrate:v", "35000k", "-profile:v", "high", "-level:v", "5.2",
+                "-b:v", "22500k", "-maxrate:v", "35000k", "-profile:v", "main", "-level:v", "5.2",
         ],
         [
             "-c:a", "aac", "-b:a", "128k"
@@ -183,6 +221,18 @@ class FileList:
         self.meta[path] = self._metacache.get(path, self._mediatools.get_meta)
         self.paths.append(path)
 
+    def add_files(self, paths, executor: Executor = None):
+        """Adds multiple files, probing the ones that aren't cached in parallel if an executor is given."""
+        if executor is None:
+            for path in paths:
+                self.add_file(path)
+            return
+
+        metas = executor.map(lambda p: self._metacache.get(p, self._mediatools.get_meta), paths)
+        for path, meta in zip(paths, metas):
+            self.meta[path] = meta
+            self.paths.append(path)
+
     def get_total_duration_ms(self):
         duration_mss = [self.meta[p].milliseconds for p in self.paths]
         if any(d is None for d in duration_mss):
@@ -253,18 +303,57 @@ class MediaTools:
 
         return info
 
-    def do_concatenation(self, file_list, output, preset: Preset, logfile_path):
+    def extract_thumbnail(self, file, seek_s, out_file, width, height):
+        """
+        Writes the keyframe at or before seek_s as a JPEG thumbnail of width x height (letterboxed), decoding only
+        keyframes. Falls back to the first keyframe if the seek yields no frame, e.g. for files with a single GOP.
+        """
+        for seek in ([seek_s, 0] if seek_s else [0]):
+            args = [
+                self.ffmpeg_exe, "-y", "-skip_frame", "nokey", "-noaccurate_seek", "-ss", str(seek), "-i", file,
+                "-map", "0:v:0", "-frames:v", "1", "-q:v", "5",
+                "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+                "-f", "image2", out_file,
+            ]
+            result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+            if result.returncode == 0 and os.path.exists(out_file) and os.path.getsize(out_file) > 0:
+                return True
+        return False
+
+    def tile_images(self, pattern, columns, rows, out_file):
+        args = [
+            self.ffmpeg_exe, "-y", "-f", "image2", "-i", pattern,
+            "-vf", f"tile={columns}x{rows}", "-frames:v", "1", "-q:v", "3", "-update", "1", out_file,
+        ]
+        result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def do_concatenation(self, file_list, output, preset: Preset, logfile_path, tuning: EncoderTuning = None,
+                         cancel: threading.Event = None, name=None):
+        # Concurrent batch jobs log through here as well; prefix messages with the job name like batch.py does
+        prefix = f"[{name}] " if name else ""
+
         with open_if_exists(logfile_path, "wb") as f:
             logfile_handle = f if f else subprocess.DEVNULL
 
             runtime = file_list.get_total_duration_ms()
 
             log.info(
-                "Starting video processing. Total duration of resulting file is %s. This can take a while...",
-                str(datetime.timedelta(milliseconds=runtime)) if runtime else "unknown"
+                "%sStarting video processing. Total duration of resulting file is %s. This can take a while...",
+                prefix, str(datetime.timedelta(milliseconds=runtime)) if runtime else "unknown"
             )
 
-            serial_commandlines, parallel_commandlines = preset.get_commandlines(self.ffmpeg_exe, file_list, output)
+            if preset.concat_strategy == ConcatStrategy.CONCAT_NATIVE_MP4:
+                try:
+                    success = concatenate_mp4(file_list.paths, output, cancel)
+                    if success:
+                        log.info("%sProcessing done.", prefix)
+                    return success
+                except Mp4ConcatUnsupported as e:
+                    log.info("%sCan't join the files directly (%s); using the ffmpeg concat demuxer instead",
+                             prefix, str(e))
+
+            serial_commandlines, parallel_commandlines = preset.get_commandlines(self.ffmpeg_exe, file_list, output, tuning)
             #args = [self.ffmpeg_exe] + preset.build_ffmpeg_params(file_list) + ["-y", output]
 
             serial_commandlines = serial_commandlines or []
@@ -279,6 +368,10 @@ class MediaTools:
             try:
                 fail = False
                 while procs:
+                    if cancel is not None and cancel.is_set():
+                        for proc in procs:
+                            proc.kill()
+                        return False
                     for proc in list(procs):
                         result = proc.poll()
                         if result is not None:
@@ -300,9 +393,11 @@ class MediaTools:
 
             if fail:
                 if logfile_path:
-                    log.error("Encoding failed. Check the log file for the error.")
+                    log.error("%sEncoding failed. Check the log file for the error.", prefix)
                 else:
-                    log.error("Encoding failed. Re-run with logging to find out what went wrong.")
+                    log.error("%sEncoding failed. Re-run with logging to find out what went wrong.", prefix)
 
             if not fail:
-                log.info("Processing done.")
+                log.info("%sProcessing done.", prefix)
+
+            return not fail
@@ -0,0 +1,587 @@
+"""
+Joins MP4/MOV files that were recorded with identical codec parameters (e.g. scenes from one camera) without running
+ffmpeg: the sample tables of all inputs are merged into a single moov box and the mdat payloads are copied into the
+output as-is, using reflinks or in-kernel copies where the OS and filesystem support them.
+"""
+import logging
+import os
+import struct
+import sys
+from itertools import chain
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+MP4_EXTENSIONS = {".mp4", ".m4v", ".mov"}
+CONTAINER_BOXES = {"moov", "trak", "mdia", "minf", "stbl", "edts"}
+
+# Sample table boxes that are rebuilt from the merged tables; other stbl children are dropped
+SAMPLE_TABLE_BOXES = {"stts", "ctts", "stsz", "stsc", "stco", "co64", "stss"}
+
+# _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940D
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class Mp4ConcatUnsupported(Exception):
+    """The inputs can't be joined natively; use ffmpeg instead."""
+    pass
+
+
+class Box:
+    def __init__(self, box_type, payload=None, children=None):
+        self.type = box_type
+        self.payload = payload
+        self.children = children
+
+    def find(self, box_type):
+        return next((c for c in self.children if c.type == box_type), None)
+
+    def find_all(self, box_type):
+        return [c for c in self.children if c.type == box_type]
+
+    def path(self, *box_types):
+        box = self
+        for box_type in box_types:
+            box = box.find(box_type)
+            if box is None:
+                return None
+        return box
+
+    def serialize(self):
+        payload = self.payload if self.children is None else b"".join(c.serialize() for c in self.children)
+        if len(payload) + 8 > 0xFFFFFFFF:
+            return struct.pack(">I4sQ", 1, self.type.encode("latin-1"), len(payload) + 16) + payload
+        return struct.pack(">I4s", len(payload) + 8, self.type.encode("latin-1")) + payload
+
+
+def _parse_boxes(data):
+    boxes = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header_size or offset + size > len(data):
+            raise Mp4ConcatUnsupported("corrupt box structure")
+        box_type = box_type.decode("latin-1")
+        payload = data[offset + header_size:offset + size]
+        if box_type in CONTAINER_BOXES:
+            boxes.append(Box(box_type, children=_parse_boxes(payload)))
+        else:
+            boxes.append(Box(box_type, payload=bytes(payload)))
+        offset += size
+    return boxes
+
+
+def _scan_top_level(f, file_size):
+    """Yields (type, payload offset, payload size) of the top-level boxes of a file."""
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack_from(">Q", header, 8)
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size or offset + size > file_size:
+            raise Mp4ConcatUnsupported("corrupt box structure")
+        yield box_type.decode("latin-1"), offset + header_size, size - header_size
+        offset += size
+
+
+# Field sizes in front of the duration of mvhd/mdhd and tkhd for version 0 and 1 (after version/flags)
+_DURATION_LAYOUTS = {
+    "mvhd": ([4, 4, 4, 4], [8, 8, 4, 8]),
+    "mdhd": ([4, 4, 4, 4], [8, 8, 4, 8]),
+    "tkhd": ([4, 4, 4, 4, 4], [8, 8, 4, 4, 8]),
+}
+_FORMATS = {4: "I", 8: "Q"}
+
+
+def _read_header_fields(box):
+    version = box.payload[0]
+    layout = _DURATION_LAYOUTS[box.type][min(version, 1)]
+    fmt = ">" + "".join(_FORMATS[s] for s in layout)
+    return list(struct.unpack_from(fmt, box.payload, 4)), 4 + sum(layout)
+
+
+def _get_timescale(box):
+    """Timescale of mvhd/mdhd."""
+    return _read_header_fields(box)[0][2]
+
+
+def _get_duration(box):
+    return _read_header_fields(box)[0][-1]
+
+
+def _with_duration(box, duration):
+    """Returns a copy of mvhd/mdhd/tkhd with the given duration, upgrading to version 1 if it doesn't fit."""
+    fields, rest_offset = _read_header_fields(box)
+    fields[-1] = duration
+    version = box.payload[0]
+    if duration > 0xFFFFFFFF:
+        version = 1
+    layout = _DURATION_LAYOUTS[box.type][min(version, 1)]
+    fmt = ">" + "".join(_FORMATS[s] for s in layout)
+    payload = bytes([version]) + box.payload[1:4] + struct.pack(fmt, *fields) + box.payload[rest_offset:]
+    return Box(box.type, payload=payload)
+
+
+def _full_box(box_type, version, fmt, *values):
+    return Box(box_type, payload=struct.pack(">B3x" + fmt, version, *values))
+
+
+def _read_descriptor_header(data, pos):
+    """Returns (tag, payload position) of an MPEG-4 descriptor (ISO 14496-1) at pos."""
+    tag = data[pos]
+    pos += 1
+    for _ in range(4):
+        pos += 1
+        if not data[pos - 1] & 0x80:
+            break
+    return tag, pos
+
+
+def _without_bitrate_info(stsd):
+    """
+    Sample descriptions carry bitrate statistics of one particular file (the btrt box, and the buffer size and
+    bitrates in the decoder config of an esds box); leave those out when comparing codec parameters.
+    """
+    result = bytearray(stsd)
+    index = result.find(b"btrt")
+    while index >= 4:
+        if struct.unpack_from(">I", result, index - 4)[0] == 20:
+            del result[index - 4:index + 16]
+            index = result.find(b"btrt", index - 4)
+        else:
+            index = result.find(b"btrt", index + 4)
+
+    index = result.find(b"esds")
+    if index >= 0:
+        try:
+            tag, pos = _read_descriptor_header(result, index + 8)
+            if tag == 0x03:
+                flags = result[pos + 2]
+                pos += 3
+                if flags & 0x80:
+                    pos += 2
+                if flags & 0x40:
+                    pos += 1 + result[pos]
+                if flags & 0x20:
+                    pos += 2
+                tag, pos = _read_descriptor_header(result, pos)
+                if tag == 0x04:
+                    # objectTypeIndication, streamType, then bufferSizeDB, maxBitrate and avgBitrate
+                    result[pos + 2:pos + 13] = bytes(11)
+        except IndexError:
+            pass
+    return bytes(result)
+
+
+def _read_table(payload, entry_fmt, header_fmt=">4xI"):
+    count, = struct.unpack_from(header_fmt, payload)
+    entry_size = struct.calcsize(">" + entry_fmt)
+    start = struct.calcsize(header_fmt)
+    if start + count * entry_size > len(payload):
+        raise Mp4ConcatUnsupported("truncated sample table")
+    return [struct.unpack_from(">" + entry_fmt, payload, start + i * entry_size) for i in range(count)]
+
+
+class Mp4Track:
+    def __init__(self, trak: Box):
+        self.trak = trak
+        mdia = trak.find("mdia")
+        stbl = trak.path("mdia", "minf", "stbl")
+        if mdia is None or stbl is None or mdia.find("mdhd") is None or stbl.find("stsd") is None:
+            raise Mp4ConcatUnsupported("track without sample table")
+        if trak.find("tkhd") is None:
+            raise Mp4ConcatUnsupported("track without header")
+        # Validate the track header up front; it is only rewritten once the output is being built
+        _read_header_fields(trak.find("tkhd"))
+
+        hdlr = mdia.find("hdlr")
+        self.handler = hdlr.payload[8:12].decode("latin-1") if hdlr else None
+        self.timescale = _get_timescale(mdia.find("mdhd"))
+        self.stsd = stbl.find("stsd").payload
+
+        self.edit_media_time = self._read_edit_media_time()
+        if stbl.find("stz2") is not None:
+            raise Mp4ConcatUnsupported("compact sample sizes (stz2) are not supported")
+
+        stts = stbl.find("stts")
+        stsz = stbl.find("stsz")
+        stsc = stbl.find("stsc")
+        if stts is None or stsz is None or stsc is None:
+            raise Mp4ConcatUnsupported("incomplete sample table")
+        self.time_to_sample = [list(e) for e in _read_table(stts.payload, "II")]
+
+        self.sample_size, self.sample_count = struct.unpack_from(">4xII", stsz.payload)
+        self.sample_sizes = None
+        if self.sample_size == 0:
+            self.sample_sizes = [e[0] for e in _read_table(stsz.payload, "I", ">8xI")]
+
+        self.sample_to_chunk = [list(e) for e in _read_table(stsc.payload, "III")]
+
+        if stbl.find("co64") is not None:
+            self.chunk_offsets = [e[0] for e in _read_table(stbl.find("co64").payload, "Q")]
+        elif stbl.find("stco") is not None:
+            self.chunk_offsets = [e[0] for e in _read_table(stbl.find("stco").payload, "I")]
+        else:
+            raise Mp4ConcatUnsupported("track without chunk offsets")
+
+        stss = stbl.find("stss")
+        self.sync_samples = [e[0] for e in _read_table(stss.payload, "I")] if stss else None
+
+        ctts = stbl.find("ctts")
+        self.composition_offsets = [list(e) for e in _read_table(ctts.payload, "II")] if ctts else None
+        self.composition_version = ctts.payload[0] if ctts else 0
+
+        if not self.sample_count or not self.time_to_sample:
+            raise Mp4ConcatUnsupported("empty track")
+
+    def _read_edit_media_time(self):
+        """
+        Returns where in the media the presentation starts according to the edit list, e.g. to skip B-frame delay or
+        audio priming samples. Only a single edit is supported, since every input applies it at its own start.
+        """
+        elst = self.trak.path("edts", "elst")
+        if elst is None:
+            return 0
+        version = elst.payload[0]
+        entries = _read_table(elst.payload, "qqhh" if version == 1 else "iihh")
+        if len(entries) > 1 or any(media_time < 0 or rate != 1 for _, media_time, rate, _ in entries):
+            raise Mp4ConcatUnsupported("edit lists with more than a single plain edit are not supported")
+        return entries[0][1] if entries else 0
+
+    @property
+    def media_duration(self):
+        return sum(count * delta for count, delta in self.time_to_sample)
+
+    def fit_to(self, duration):
+        """
+        Stretches or shortens the last sample so the track lasts exactly duration (in track timescale) units, which
+        keeps the tracks of consecutive files aligned like the ffmpeg concat demuxer does. Returns False if the track
+        runs on for longer than its last sample, e.g. because of AAC priming samples.
+        """
+        missing = duration - self.media_duration
+        count, delta = self.time_to_sample[-1]
+        if missing == 0:
+            return True
+        if delta + missing <= 0:
+            return False
+        if count > 1:
+            self.time_to_sample[-1][0] -= 1
+            self.time_to_sample.append([1, delta + missing])
+        else:
+            self.time_to_sample[-1][1] += missing
+        return True
+
+
+class Mp4Input:
+    def __init__(self, path):
+        self.path = path
+        self.ftyp = None
+        moov_range = None
+        mdats = []
+
+        file_size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            for box_type, offset, size in _scan_top_level(f, file_size):
+                if box_type == "ftyp":
+                    f.seek(offset)
+                    self.ftyp = f.read(size)
+                elif box_type == "moov":
+                    moov_range = (offset, size)
+                elif box_type == "mdat" and size:
+                    mdats.append((offset, size))
+                elif box_type in ("moof", "mfra"):
+                    raise Mp4ConcatUnsupported(f"{path} is a fragmented MP4")
+
+            if moov_range is None:
+                raise Mp4ConcatUnsupported(f"{path} is not an MP4/MOV file")
+            if len(mdats) != 1:
+                raise Mp4ConcatUnsupported(f"{path} does not have exactly one mdat box")
+
+            f.seek(moov_range[0])
+            self.moov = Box("moov", children=_parse_boxes(f.read(moov_range[1])))
+
+        self.mdat_offset, self.mdat_size = mdats[0]
+
+        if self.moov.find("mvex") is not None:
+            raise Mp4ConcatUnsupported(f"{path} is a fragmented MP4")
+
+        mvhd = self.moov.find("mvhd")
+        if mvhd is None:
+            raise Mp4ConcatUnsupported(f"{path} has no movie header")
+        self.timescale = _get_timescale(mvhd)
+        self.duration = _get_duration(mvhd)
+
+        self.tracks = [Mp4Track(trak) for trak in self.moov.find_all("trak")]
+        for track in self.tracks:
+            if any(not self.mdat_offset <= o < self.mdat_offset + self.mdat_size for o in track.chunk_offsets):
+                raise Mp4ConcatUnsupported(f"{path} has media data outside its mdat box")
+            if not track.fit_to(round(self.duration * track.timescale / self.timescale)):
+                raise Mp4ConcatUnsupported(f"a {track.handler} track of {path} is longer than the file itself")
+
+    def check_compatible(self, other: 'Mp4Input'):
+        if len(self.tracks) != len(other.tracks):
+            raise Mp4ConcatUnsupported(f"{other.path} has a different number of tracks than {self.path}")
+        for i, (track, other_track) in enumerate(zip(self.tracks, other.tracks)):
+            if (track.handler != other_track.handler or track.timescale != other_track.timescale
+                    or track.edit_media_time != other_track.edit_media_time):
+                raise Mp4ConcatUnsupported(f"track {i} of {other.path} differs from the one in {self.path}")
+            if _without_bitrate_info(track.stsd) != _without_bitrate_info(other_track.stsd):
+                raise Mp4ConcatUnsupported(
+                    f"track {i} of {other.path} has different codec parameters (stsd) than the one in {self.path}"
+                )
+
+
+def _merge_track(template: Mp4Track, tracks, segment_offsets, use_co64):
+    """
+    Builds the merged sample table boxes for one track. segment_offsets maps the mdat payload start of every input
+    to where that payload ends up in the output.
+    """
+    time_to_sample = []
+    sample_sizes = []
+    constant_size = template.sample_size if all(t.sample_size == template.sample_size for t in tracks) else 0
+    sample_to_chunk = []
+    chunk_offsets = []
+    sync_samples = []
+    composition_offsets = []
+    any_sync_table = any(t.sync_samples is not None for t in tracks)
+    any_composition = any(t.composition_offsets is not None for t in tracks)
+
+    sample_base = 0
+    for track, (src_start, dst_start) in zip(tracks, segment_offsets):
+        for count, delta in track.time_to_sample:
+            if time_to_sample and time_to_sample[-1][1] == delta:
+                time_to_sample[-1][0] += count
+            else:
+                time_to_sample.append([count, delta])
+
+        if not constant_size:
+            sample_sizes += track.sample_sizes or [track.sample_size] * track.sample_count
+
+        chunk_base = len(chunk_offsets)
+        for first_chunk, samples_per_chunk, description_index in track.sample_to_chunk:
+            if sample_to_chunk and sample_to_chunk[-1][1:] == [samples_per_chunk, description_index]:
+                continue
+            sample_to_chunk.append([first_chunk + chunk_base, samples_per_chunk, description_index])
+        chunk_offsets += [o - src_start + dst_start for o in track.chunk_offsets]
+
+        if any_sync_table:
+            if track.sync_samples is None:
+                sync_samples += range(sample_base + 1, sample_base + track.sample_count + 1)
+            else:
+                sync_samples += [s + sample_base for s in track.sync_samples]
+
+        if any_composition:
+            for count, offset in track.composition_offsets or [[track.sample_count, 0]]:
+                if composition_offsets and composition_offsets[-1][1] == offset:
+                    composition_offsets[-1][0] += count
+                else:
+                    composition_offsets.append([count, offset])
+
+        sample_base += track.sample_count
+
+    boxes = [
+        _full_box("stts", 0, f"I{len(time_to_sample) * 2}I", len(time_to_sample), *chain.from_iterable(time_to_sample)),
+    ]
+    if any_composition:
+        version = max(t.composition_version for t in tracks)
+        boxes.append(_full_box("ctts", version, f"I{len(composition_offsets) * 2}I",
+                               len(composition_offsets), *chain.from_iterable(composition_offsets)))
+    if any_sync_table:
+        boxes.append(_full_box("stss", 0, f"I{len(sync_samples)}I", len(sync_samples), *sync_samples))
+    boxes.append(_full_box("stsc", 0, f"I{len(sample_to_chunk) * 3}I", len(sample_to_chunk), *chain.from_iterable(sample_to_chunk)))
+    boxes.append(_full_box("stsz", 0, f"II{len(sample_sizes)}I", constant_size, sample_base, *sample_sizes))
+    if use_co64:
+        boxes.append(_full_box("co64", 0, f"I{len(chunk_offsets)}Q", len(chunk_offsets), *chunk_offsets))
+    else:
+        boxes.append(_full_box("stco", 0, f"I{len(chunk_offsets)}I", len(chunk_offsets), *chunk_offsets))
+    return boxes, sum(count * delta for count, delta in time_to_sample)
+
+
+def _build_moov(inputs, segment_offsets, use_co64):
+    first = inputs[0]
+    movie_duration = round(sum(i.duration / i.timescale for i in inputs) * first.timescale)
+
+    children = []
+    for box in first.moov.children:
+        if box.type == "mvhd":
+            children.append(_with_duration(box, movie_duration))
+        elif box.type == "trak":
+            track_index = first.moov.find_all("trak").index(box)
+            children.append(_build_trak(first.tracks[track_index], [i.tracks[track_index] for i in inputs],
+                                        first.timescale, segment_offsets, use_co64))
+        else:
+            children.append(box)
+    return Box("moov", children=children)
+
+
+def _build_trak(template: Mp4Track, tracks, movie_timescale, segment_offsets, use_co64):
+    sample_table, media_duration = _merge_track(template, tracks, segment_offsets, use_co64)
+    track_duration = round(media_duration * movie_timescale / template.timescale)
+
+    def rebuild(box):
+        if box.type == "tkhd":
+            return _with_duration(box, track_duration)
+        if box.type == "mdhd":
+            return _with_duration(box, media_duration)
+        if box.type == "edts":
+            if not template.edit_media_time:
+                return None
+            version = 1 if max(track_duration, template.edit_media_time) > 0x7FFFFFFF else 0
+            elst = _full_box("elst", version, "Iqqhh" if version == 1 else "Iiihh",
+                             1, track_duration, template.edit_media_time, 1, 0)
+            return Box("edts", children=[elst])
+        if box.type == "stbl":
+            dropped = [c.type for c in box.children if c.type not in SAMPLE_TABLE_BOXES and c.type != "stsd"]
+            if dropped:
+                log.debug("Dropping sample table boxes %s", ", ".join(dropped))
+            return Box("stbl", children=[box.find("stsd")] + sample_table)
+        if box.children is not None:
+            return Box(box.type, children=[c for c in map(rebuild, box.children) if c is not None])
+        return box
+
+    return rebuild(template.trak)
+
+
+class _RangeCopier:
+    """
+    Copies byte ranges between files, preferring reflinks (FICLONERANGE), then in-kernel copies
+    (copy_file_range/sendfile), then plain reads and writes. Remembers which methods don't work here.
+    Copies return False if cancelled through the cancel event.
+    """
+    def __init__(self, block_size, cancel=None):
+        self.block_size = block_size
+        self.cancel = cancel
+        self.can_clone = fcntl is not None and sys.platform.startswith("linux")
+        self.can_copy_file_range = hasattr(os, "copy_file_range")
+        self.can_sendfile = hasattr(os, "sendfile") and sys.platform.startswith("linux")
+
+    def copy(self, src, dst, src_offset, dst_offset, length):
+        if self.can_clone and src_offset % self.block_size == dst_offset % self.block_size:
+            head = min(-src_offset % self.block_size, length)
+            middle = (length - head) // self.block_size * self.block_size
+            if middle and self._clone(src, dst, src_offset + head, dst_offset + head, middle):
+                tail_start = head + middle
+                return self._copy(src, dst, src_offset, dst_offset, head) and \
+                    self._copy(src, dst, src_offset + tail_start, dst_offset + tail_start, length - tail_start)
+        return self._copy(src, dst, src_offset, dst_offset, length)
+
+    def _clone(self, src, dst, src_offset, dst_offset, length):
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONERANGE, struct.pack("=qQQQ", src.fileno(), src_offset, length, dst_offset))
+            return True
+        except OSError:
+            log.debug("Reflinks are not supported here; copying data instead")
+            self.can_clone = False
+            return False
+
+    def _copy(self, src, dst, src_offset, dst_offset, length):
+        while length > 0:
+            if self.cancel is not None and self.cancel.is_set():
+                return False
+            copied = 0
+            if self.can_copy_file_range:
+                try:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), length, src_offset, dst_offset)
+                except OSError:
+                    self.can_copy_file_range = False
+            if not copied and self.can_sendfile:
+                try:
+                    dst.seek(dst_offset)
+                    copied = os.sendfile(dst.fileno(), src.fileno(), src_offset, length)
+                except OSError:
+                    self.can_sendfile = False
+            if not copied:
+                src.seek(src_offset)
+                dst.seek(dst_offset)
+                data = src.read(min(length, COPY_BUFFER_SIZE))
+                if not data:
+                    raise OSError(f"Unexpected end of file in {src.name}")
+                copied = dst.write(data)
+            src_offset += copied
+            dst_offset += copied
+            length -= copied
+        return True
+
+
+def concatenate_mp4(paths, output, cancel=None):
+    """
+    Joins the given MP4/MOV files into output. Raises Mp4ConcatUnsupported before writing anything if the files
+    can't be joined this way. Returns False if cancelled through the cancel event.
+    """
+    if os.path.splitext(output)[1].lower() not in MP4_EXTENSIONS:
+        raise Mp4ConcatUnsupported("output is not an MP4/MOV file")
+    if not paths:
+        raise Mp4ConcatUnsupported("no input files")
+
+    try:
+        inputs = [Mp4Input(path) for path in paths]
+        for other in inputs[1:]:
+            inputs[0].check_compatible(other)
+    except (struct.error, IndexError) as e:
+        raise Mp4ConcatUnsupported(f"malformed input ({e})")
+
+    ftyp = Box("ftyp", payload=inputs[0].ftyp).serialize() if inputs[0].ftyp is not None else b""
+    mdat_header_size = 16
+    alignment = os.stat(os.path.dirname(os.path.abspath(output))).st_blksize or 4096
+
+    def layout(moov_size):
+        """Places every input's mdat payload at an offset with the same block alignment as in the input."""
+        pos = len(ftyp) + moov_size + mdat_header_size
+        segments = []
+        for i in inputs:
+            pos += (i.mdat_offset - pos) % alignment
+            segments.append((i.mdat_offset, pos))
+            pos += i.mdat_size
+        return segments, pos
+
+    # Offsets don't change the size of the moov box, so lay out with dummy offsets first
+    dummy_offsets = [(0, 0)] * len(inputs)
+    _, end = layout(len(_build_moov(inputs, dummy_offsets, use_co64=True).serialize()))
+    use_co64 = end > 0xFFFFFFFF
+    moov_size = len(_build_moov(inputs, dummy_offsets, use_co64).serialize())
+    segments, end = layout(moov_size)
+    moov = _build_moov(inputs, segments, use_co64).serialize()
+    mdat_start = len(ftyp) + len(moov)
+
+    cancelled = False
+    dst = None
+    try:
+        with open(output, "wb", buffering=0) as dst:
+            copier = _RangeCopier(alignment, cancel)
+            dst.write(ftyp + moov + struct.pack(">I4sQ", 1, b"mdat", end - mdat_start))
+
+            for i, (src_offset, dst_offset) in zip(inputs, segments):
+                log.debug("Copying media data of %s", i.path)
+                with open(i.path, "rb", buffering=0) as src:
+                    if not copier.copy(src, dst, src_offset, dst_offset, i.mdat_size):
+                        cancelled = True
+                        break
+            dst.truncate(end)
+    except BaseException:
+        # Only clean up if the output was actually opened (and truncated) by us; also on Ctrl-C
+        if dst is not None:
+            os.unlink(output)
+        raise
+
+    if cancelled:
+        os.unlink(output)
+        return False
+    return True
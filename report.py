@@ -1,5 +1,6 @@
 import xlsxwriter
 
+from thumbnails import THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT
 from util import ms_to_mm_ss_ms
 
 
@@ -52,7 +53,7 @@ def write_srt(path, file_list, time_fmt='%Y-%m-%d %H:%M:%S', duration=5):
                 offset_ms += info.milliseconds
 
 
-def write_xlsx_report(xlsx, file_list):
+def write_xlsx_report(xlsx, file_list, thumbnails=None):
     with xlsxwriter.Workbook(xlsx) as workbook:
         sheet = workbook.add_worksheet()
         int_fmt = workbook.add_format({'num_format': '0', 'align': 'left'})
@@ -68,11 +69,16 @@ def write_xlsx_report(xlsx, file_list):
         sheet.write(0, 5, 'Duration ms', bold_fmt)
         sheet.write(0, 6, 'Duration frames', bold_fmt)
         sheet.write(0, 7, 'Source filename', bold_fmt)
+        if thumbnails:
+            sheet.write(0, 8, 'Thumbnail', bold_fmt)
 
         sheet.set_column(0, 2, 15)
         sheet.set_column(3, 3, 25)
         sheet.set_column(4, 6, 15)
         sheet.set_column(7, 7, 100)
+        if thumbnails:
+            # Column width is in characters of ~7 pixels, row height in points
+            sheet.set_column(8, 8, (THUMBNAIL_WIDTH + 4) / 7)
 
         offset_ms = 0
         offset_frames = 0
@@ -91,6 +97,9 @@ def write_xlsx_report(xlsx, file_list):
             if info.frames:
                 sheet.write(row, 6, info.frames, int_fmt)
             sheet.write(row, 7, file)
+            if thumbnails and thumbnails.get(file):
+                sheet.set_row(row, (THUMBNAIL_HEIGHT + 4) * 0.75)
+                sheet.insert_image(row, 8, thumbnails[file], {'x_offset': 2, 'y_offset': 2})
 
             if info.milliseconds:
                 offset_ms += info.milliseconds
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from batch import BatchException, BatchJob, BatchScheduler
+from calibrate import EncoderTuning
+from mediatools import encode_presets
+
+
+class StubMediaTools:
+    """Records which jobs run at the same time instead of running ffmpeg."""
+    def __init__(self, durations, threads):
+        self.durations = durations
+        self.threads = threads
+        self.intervals = {}
+        self.running = set()
+        self.max_threads = 0
+        self._lock = threading.Lock()
+
+    def do_concatenation(self, file_list, output, preset, logfile_path, tuning=None, cancel=None, name=None):
+        with self._lock:
+            self.running.add(name)
+            self.max_threads = max(self.max_threads, sum(self.threads[n] for n in self.running))
+        start = time.monotonic()
+        time.sleep(self.durations[name])
+        with self._lock:
+            self.running.remove(name)
+        self.intervals[name] = (start, time.monotonic())
+        return True
+
+
+def make_job(name, preset_name, threads=None):
+    tuning = EncoderTuning("medium", threads) if threads else None
+    return BatchJob(name, None, name, preset_name, encode_presets[preset_name], None, tuning)
+
+
+def run_jobs(jobs, durations, cpu_budget, io_budget=1):
+    tools = StubMediaTools(durations, {j.name: j.get_cpu_cost(cpu_budget) for j in jobs})
+    BatchScheduler(tools, cpu_budget, io_budget).run(jobs)
+    assert all(j.success for j in jobs)
+    return tools
+
+
+def overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def test_fits():
+    scheduler = BatchScheduler(None, cpu_budget=4, io_budget=1)
+    transcode = make_job("t1", "1080p", threads=4)
+    copy = make_job("c1", "copy")
+
+    assert scheduler._fits(transcode, [])
+    assert scheduler._fits(copy, [transcode])
+    assert not scheduler._fits(make_job("t2", "1080p", threads=1), [transcode])
+    assert not scheduler._fits(make_job("c2", "copy"), [copy])
+    # Uncalibrated transcodes claim the whole CPU budget
+    assert not scheduler._fits(make_job("t3", "1080p"), [make_job("t4", "1080p", threads=1)])
+
+
+def test_copy_overlaps_transcode():
+    jobs = [make_job("transcode", "1080p"), make_job("copy", "copy")]
+    tools = run_jobs(jobs, {"transcode": 1.0, "copy": 0.2}, cpu_budget=4)
+
+    assert overlap(tools.intervals["transcode"], tools.intervals["copy"])
+
+
+def test_transcodes_stay_within_cpu_budget():
+    jobs = [make_job(f"t{i}", "1080p", threads=2) for i in range(3)]
+    tools = run_jobs(jobs, {"t0": 0.2, "t1": 0.2, "t2": 0.2}, cpu_budget=4)
+
+    assert tools.max_threads == 4
+    assert not overlap(tools.intervals["t0"], tools.intervals["t2"])
+    assert not overlap(tools.intervals["t1"], tools.intervals["t2"])
+
+
+@pytest.mark.parametrize("cpu_budget, io_budget", [(0, 1), (1, 0)])
+def test_budget_below_one(cpu_budget, io_budget):
+    with pytest.raises(BatchException):
+        BatchScheduler(None, cpu_budget, io_budget)
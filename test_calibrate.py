@@ -0,0 +1,45 @@
+import pytest
+
+from calibrate import HostProfile, Measurement, select_tuning
+
+
+def measurement(speed_preset, threads, realtime_factor):
+    return Measurement({
+        "speed_preset": speed_preset, "threads": threads, "realtime_factor": realtime_factor, "bitrate_kbps": 1000,
+    })
+
+
+MEASUREMENTS = [
+    measurement("veryfast", 4, 6.0),
+    measurement("medium", 2, 1.2),
+    measurement("medium", 4, 2.1),
+    measurement("medium", 8, 2.5),
+    measurement("slow", 8, 1.5),
+]
+
+
+@pytest.mark.parametrize("required, speed_preset, threads", [
+    (1.0, "slow", 8),
+    (2.0, "medium", 4),
+    (5.0, "veryfast", 4),
+    (10.0, "veryfast", 4),
+], ids=["slowest-preset", "fewest-threads", "only-fast-enough", "fallback-to-fastest"])
+def test_select_tuning(required, speed_preset, threads):
+    tuning = select_tuning(MEASUREMENTS, required)
+    assert (tuning.speed_preset, tuning.threads) == (speed_preset, threads)
+
+
+def test_select_tuning_without_measurements():
+    assert select_tuning([], 1.0) is None
+
+
+@pytest.mark.parametrize("target_realtime, target_hours, duration_ms, required", [
+    (None, 2, 6 * 3600_000, 3.0),
+    (1.5, 2, 2 * 3600_000, 1.5),
+    (None, 2, None, 1.0),
+    (1.5, 2, None, 1.5),
+], ids=["hours", "realtime-wins", "hours-unknown-duration", "realtime-unknown-duration"])
+def test_required_realtime_factor(target_realtime, target_hours, duration_ms, required):
+    profile = HostProfile("host")
+    profile.set_calibration("1080p", MEASUREMENTS, target_realtime, target_hours)
+    assert profile.get_required_realtime_factor("1080p", duration_ms) == pytest.approx(required)
@@ -0,0 +1,126 @@
+import struct
+import threading
+
+import pytest
+
+from mp4concat import concatenate_mp4, Mp4ConcatUnsupported, Mp4Input
+
+DEFAULT_STSD = struct.pack(">I", 1) + struct.pack(">I4s", 16, b"avc1") + b"codecpar"
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def full_box(box_type, payload, version=0):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def build_mp4(frames, frame_duration=40, stsd=DEFAULT_STSD, mvhd=None):
+    """Builds a single-track MP4 with one chunk holding all frames, with moov after mdat like most cameras do."""
+    duration = len(frames) * frame_duration
+    ftyp = box(b"ftyp", b"isom\0\0\2\0isomavc1")
+    mdat = box(b"mdat", b"".join(frames))
+    chunk_offset = len(ftyp) + 8
+
+    stbl = box(b"stbl", b"".join([
+        full_box(b"stsd", stsd),
+        full_box(b"stts", struct.pack(">III", 1, len(frames), frame_duration)),
+        full_box(b"stss", struct.pack(">II", 1, 1)),
+        full_box(b"stsc", struct.pack(">IIII", 1, 1, len(frames), 1)),
+        full_box(b"stsz", struct.pack(">II", 0, len(frames)) + b"".join(struct.pack(">I", len(f)) for f in frames)),
+        full_box(b"stco", struct.pack(">II", 1, chunk_offset)),
+    ]))
+    mdia = box(b"mdia", b"".join([
+        full_box(b"mdhd", struct.pack(">IIIIHH", 0, 0, 1000, duration, 0, 0)),
+        full_box(b"hdlr", struct.pack(">I4s12x", 0, b"vide") + b"\0"),
+        box(b"minf", stbl),
+    ]))
+    trak = box(b"trak", full_box(b"tkhd", struct.pack(">IIIII", 0, 0, 1, 0, duration) + bytes(60)) + mdia)
+    if mvhd is None:
+        mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, duration) + bytes(80))
+    return ftyp + mdat + box(b"moov", mvhd + trak)
+
+
+def read_samples(path):
+    mp4 = Mp4Input(str(path))
+    track = mp4.tracks[0]
+    data = path.read_bytes()
+
+    runs = track.sample_to_chunk + [[len(track.chunk_offsets) + 1, 0, 0]]
+    samples = []
+    for (first_chunk, samples_per_chunk, _), (next_first_chunk, _, _) in zip(runs, runs[1:]):
+        for offset in track.chunk_offsets[first_chunk - 1:next_first_chunk - 1]:
+            for _ in range(samples_per_chunk):
+                size = track.sample_sizes[len(samples)]
+                samples.append(data[offset:offset + size])
+                offset += size
+    return mp4, track, samples
+
+
+def test_concatenate(tmp_path):
+    first = [b"key1" * 10, b"p1", b"p2"]
+    second = [b"key2" * 20, b"p3"]
+    (tmp_path / "a.mp4").write_bytes(build_mp4(first))
+    (tmp_path / "b.mp4").write_bytes(build_mp4(second))
+    out = tmp_path / "out.mp4"
+
+    assert concatenate_mp4([str(tmp_path / "a.mp4"), str(tmp_path / "b.mp4")], str(out))
+
+    mp4, track, samples = read_samples(out)
+    assert samples == first + second
+    assert track.sample_count == 5
+    assert track.sync_samples == [1, 4]
+    assert track.time_to_sample == [[5, 40]]
+    assert mp4.duration == 200
+
+
+def test_different_codec_parameters(tmp_path):
+    (tmp_path / "a.mp4").write_bytes(build_mp4([b"frame"]))
+    other_stsd = struct.pack(">I", 1) + struct.pack(">I4s", 16, b"avc1") + b"otherpar"
+    (tmp_path / "b.mp4").write_bytes(build_mp4([b"frame"], stsd=other_stsd))
+
+    with pytest.raises(Mp4ConcatUnsupported):
+        concatenate_mp4([str(tmp_path / "a.mp4"), str(tmp_path / "b.mp4")], str(tmp_path / "out.mp4"))
+    assert not (tmp_path / "out.mp4").exists()
+
+
+@pytest.mark.parametrize("data", [
+    struct.pack(">I4s", 1, b"mdat") + b"\0\0",
+    build_mp4([b"frame"], mvhd=box(b"mvhd", b"\0" * 6)),
+], ids=["truncated-64bit-mdat-header", "short-mvhd"])
+def test_malformed_input(tmp_path, data):
+    (tmp_path / "a.mp4").write_bytes(data)
+
+    with pytest.raises(Mp4ConcatUnsupported):
+        concatenate_mp4([str(tmp_path / "a.mp4")], str(tmp_path / "out.mp4"))
+    assert not (tmp_path / "out.mp4").exists()
+
+
+def test_non_mp4_output(tmp_path):
+    (tmp_path / "a.mp4").write_bytes(build_mp4([b"frame"]))
+
+    with pytest.raises(Mp4ConcatUnsupported):
+        concatenate_mp4([str(tmp_path / "a.mp4")], str(tmp_path / "out.mkv"))
+
+
+@pytest.mark.parametrize("error", [OSError("disk full"), KeyboardInterrupt()], ids=["os-error", "ctrl-c"])
+def test_copy_failure_removes_output(tmp_path, monkeypatch, error):
+    (tmp_path / "a.mp4").write_bytes(build_mp4([b"frame"]))
+
+    def failing_copy(*args):
+        raise error
+    monkeypatch.setattr("mp4concat._RangeCopier.copy", failing_copy)
+
+    with pytest.raises(type(error)):
+        concatenate_mp4([str(tmp_path / "a.mp4")], str(tmp_path / "out.mp4"))
+    assert not (tmp_path / "out.mp4").exists()
+
+
+def test_cancel_removes_output(tmp_path):
+    (tmp_path / "a.mp4").write_bytes(build_mp4([b"frame" * 1000]))
+    cancel = threading.Event()
+    cancel.set()
+
+    assert not concatenate_mp4([str(tmp_path / "a.mp4")], str(tmp_path / "out.mp4"), cancel)
+    assert not (tmp_path / "out.mp4").exists()
@@ -0,0 +1,95 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from thumbnails import ThumbnailCache, write_contact_sheet
+
+
+class StubGetter:
+    def __init__(self, succeed=True):
+        self.succeed = succeed
+        self.calls = 0
+
+    def __call__(self, path, out):
+        self.calls += 1
+        if self.succeed:
+            with open(out, "wb") as f:
+                f.write(b"jpeg")
+        return self.succeed
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ThumbnailCache()
+    cache.cache_dir = str(tmp_path / "cache")
+    return cache
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"video")
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    return str(path)
+
+
+def test_cache_hit(cache, video):
+    getter = StubGetter()
+
+    thumbnail = cache.get(video, getter)
+    assert open(thumbnail, "rb").read() == b"jpeg"
+    assert cache.get(video, getter) == thumbnail
+    assert getter.calls == 1
+
+
+def test_cache_miss_on_failed_extraction(cache, video):
+    getter = StubGetter(succeed=False)
+
+    assert cache.get(video, getter) is None
+    assert cache.get(video, getter) is None
+    assert getter.calls == 2
+    assert not any(files for _, _, files in os.walk(cache.cache_dir))
+
+
+def touch(path):
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+
+
+def append_keeping_mtime(path):
+    with open(path, "ab") as f:
+        f.write(b"more")
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+
+
+@pytest.mark.parametrize("change", [touch, append_keeping_mtime], ids=["mtime", "size"])
+def test_cache_invalidation(cache, video, change):
+    getter = StubGetter()
+    thumbnail = cache.get(video, getter)
+
+    change(video)
+    assert cache.get(video, getter) != thumbnail
+    assert getter.calls == 2
+
+
+def test_missing_file(cache, tmp_path):
+    assert cache.get(str(tmp_path / "missing.mp4"), StubGetter()) is None
+
+
+def test_unwritable_cache_dir(cache, video, tmp_path):
+    (tmp_path / "file").write_bytes(b"")
+    cache.cache_dir = str(tmp_path / "file" / "thumbnails")
+
+    assert cache.get(video, StubGetter()) is None
+
+
+def test_contact_sheet_layout(tmp_path):
+    thumbnail = tmp_path / "thumb.jpg"
+    thumbnail.write_bytes(b"jpeg")
+    paths = [f"video{i}.mp4" for i in range(150)]
+    tiles = []
+    mediatools = SimpleNamespace(tile_images=lambda pattern, columns, rows, out: tiles.append((columns, rows)) or True)
+
+    assert write_contact_sheet(mediatools, SimpleNamespace(paths=paths), dict.fromkeys(paths, str(thumbnail)),
+                               str(tmp_path / "sheet.jpg"))
+    assert tiles == [(13, 12)]
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import math
+import os
+import shutil
+import tempfile
+
+from appdirs import user_cache_dir
+
+log = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 90
+
+
+class ThumbnailCache:
+    """
+    Thumbnails stored in the user cache directory, keyed by a fingerprint of the source file's path, size and
+    modification time, so a changed file gets a new thumbnail.
+    """
+    def __init__(self):
+        self.cache_dir = os.path.join(user_cache_dir('catvid', 'bad-bit'), 'thumbnails')
+
+    def get_path(self, path):
+        """Returns None if the file can't be fingerprinted, e.g. because it's missing."""
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            log.debug("Can't fingerprint %s: %s", path, e)
+            return None
+        fingerprint = hashlib.sha1(f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, fingerprint[:2], fingerprint + ".jpg")
+
+    def get(self, path, getter):
+        thumbnail = self.get_path(path)
+        if thumbnail is None:
+            return None
+        if os.path.exists(thumbnail):
+            return thumbnail
+
+        try:
+            os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+            # Write next to the final location first, so a half-written file never ends up in the cache
+            tfh, temp_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(thumbnail))
+            os.close(tfh)
+        except OSError as e:
+            log.warning("Can't write to thumbnail cache: %s", e)
+            return None
+        try:
+            if not getter(path, temp_path):
+                return None
+            os.replace(temp_path, thumbnail)
+            return thumbnail
+        except OSError as e:
+            log.warning("Can't write to thumbnail cache: %s", e)
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+
+def generate_thumbnails(mediatools, file_list, executor, cache: ThumbnailCache = None):
+    """Returns a dict of input path -> thumbnail path (or None if no frame could be extracted)."""
+    cache = cache or ThumbnailCache()
+
+    def get_thumbnail(path):
+        milliseconds = file_list.meta[path].milliseconds
+        seek_s = milliseconds / 2000 if milliseconds else 0
+        return cache.get(
+            path, lambda p, out: mediatools.extract_thumbnail(p, seek_s, out, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+        )
+
+    thumbnails = dict(zip(file_list.paths, executor.map(get_thumbnail, file_list.paths)))
+    missing = sum(1 for t in thumbnails.values() if t is None)
+    if missing:
+        log.warning("Could not extract a thumbnail from %s files", missing)
+    return thumbnails
+
+
+def write_contact_sheet(mediatools, file_list, thumbnails, out_path, columns=None):
+    """
+    Tiles the thumbnails of all files, in file list order, into a single image. By default the sheet is about as
+    wide as it is high, which keeps large collections within the 65535 pixel limit of JPEG.
+    """
+    paths = [thumbnails[p] for p in file_list.paths if thumbnails.get(p)]
+    if not paths:
+        log.warning("No thumbnails available; not writing contact sheet")
+        return False
+
+    columns = columns or math.ceil(math.sqrt(len(paths)))
+    rows = (len(paths) + columns - 1) // columns
+    with tempfile.TemporaryDirectory() as tempdir:
+        for i, path in enumerate(paths):
+            shutil.copyfile(path, os.path.join(tempdir, f"{i:06d}.jpg"))
+        if not mediatools.tile_images(os.path.join(tempdir, "%06d.jpg"), columns, rows, out_path):
+            log.error("Could not write contact sheet %s", out_path)
+            return False
+    return True